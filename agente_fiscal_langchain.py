@@ -2,7 +2,9 @@
 
 import os
 import json
+import hashlib
 import re
+import threading
 import fitz  # PyMuPDF
 from lxml import etree
 from dotenv import load_dotenv
@@ -10,10 +12,12 @@ from langchain_openai import ChatOpenAI
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.prompts import ChatPromptTemplate
 from langchain.tools import tool
-from decimal import Decimal, InvalidOperation
+from langchain_core.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 # Importa a ferramenta de consulta NCM
-from tipi.consultartipi import consultar_ncm
+from tipi.consultartipi import consultar_ncm, consultar_ncms_batch
 
 # --- Configuração do Agente LangChain ---
 
@@ -22,54 +26,131 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
     raise ValueError("A variável de ambiente OPENAI_API_KEY não foi encontrada.")
 
-llm = ChatOpenAI(api_key=openai_api_key, model="gpt-4-turbo", temperature=0)
+llm = ChatOpenAI(api_key=openai_api_key, model="gpt-4-turbo", temperature=0, streaming=True)
+# Modelo menor e mais barato, usado para resumir auditorias simples (sem erros)
+llm_mini = ChatOpenAI(api_key=openai_api_key, model="gpt-4o-mini", temperature=0, streaming=True)
+# Auditorias sem erros e com até este número de avisos/NCMs usam o llm_mini
+LIMITE_COMPLEXIDADE_LLM_MINI = 5
+
+# Tag usada para identificar a geração da conclusão da auditoria nos callbacks,
+# permitindo que a interface exiba os tokens à medida que são gerados.
+TAG_CONCLUSAO = "conclusao_auditoria"
+
+# Cache das respostas do LLM: prompts idênticos (ex.: a mesma conclusão de auditoria)
+# são respondidos a partir do disco, sem nova chamada à OpenAI.
+set_llm_cache(SQLiteCache(database_path=".langchain_cache.db"))
+
+# --- BANCO DE DADOS DAS AUDITORIAS ---
+
+# Um documento auditado por linha (JSON Lines), gravado apenas por append.
+DB_DOCUMENTOS = 'db_documentos.jsonl'
+# Formato anterior: um único array JSON reescrito a cada gravação.
+DB_DOCUMENTOS_LEGADO = 'db_documentos.json'
+_DB_LOCK = threading.Lock()
+
+def migrar_banco_legado():
+    """
+    Converte o banco no formato antigo (array JSON) para JSON Lines.
+    Executa apenas se o arquivo antigo existir e o novo ainda não; o arquivo
+    antigo é mantido com o sufixo '.migrado' como backup.
+    """
+    if os.path.exists(DB_DOCUMENTOS) or not os.path.exists(DB_DOCUMENTOS_LEGADO):
+        return
+    with _DB_LOCK:
+        registros = []
+        if os.path.getsize(DB_DOCUMENTOS_LEGADO) > 0:
+            with open(DB_DOCUMENTOS_LEGADO, 'r', encoding='utf-8') as f:
+                try:
+                    registros = json.load(f)
+                except json.JSONDecodeError:
+                    print(f"Aviso: '{DB_DOCUMENTOS_LEGADO}' está corrompido e não foi migrado.")
+                    return
+        with open(DB_DOCUMENTOS, 'w', encoding='utf-8') as f:
+            for registro in registros:
+                f.write(json.dumps(registro, ensure_ascii=False) + '\n')
+        os.replace(DB_DOCUMENTOS_LEGADO, DB_DOCUMENTOS_LEGADO + '.migrado')
+        print(f"Banco '{DB_DOCUMENTOS_LEGADO}' migrado para '{DB_DOCUMENTOS}' ({len(registros)} registros).")
+
+migrar_banco_legado()
 
 # --- LÓGICA DE AUDITORIA (MOVIMOS DE FERRAMENTAS_FISCAIS.PY) ---
 
+# Tabelas de conversão de números: '1.234,56' -> '1234.56' e '12,5' -> '12.5'
+_NUM_TRANS_BOTH = str.maketrans({'.': '', ',': '.'})
+_NUM_TRANS_COMMA = str.maketrans({',': '.'})
+
 def _to_decimal(value_str):
     """Converte uma string para Decimal, tratando formatos pt-BR e padrão."""
     if not value_str:
         return Decimal('0.0')
     value_str = str(value_str).strip()
     if ',' in value_str and '.' in value_str:
-        value_str = value_str.replace('.', '')
-    value_str = value_str.replace(',', '.')
+        value_str = value_str.translate(_NUM_TRANS_BOTH)
+    else:
+        value_str = value_str.translate(_NUM_TRANS_COMMA)
     return Decimal(value_str)
 
-def validar_cnpj(cnpj: str) -> bool:
-    cnpj = ''.join(filter(str.isdigit, cnpj))
+def _to_cents(value_str) -> int:
+    """
+    Converte um valor monetário (ver _to_decimal) para centavos inteiros.
+    Valores não finitos (NaN, Infinity) levantam InvalidOperation.
+    """
+    valor = _to_decimal(value_str)
+    if not valor.is_finite():
+        raise InvalidOperation(f"Valor monetário não finito: {value_str!r}")
+    return int((valor * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+# Pesos dos dígitos verificadores de CNPJ e CPF, pré-calculados uma única vez.
+# Tuplas em Python puro: com 11 a 14 dígitos, o custo fixo de cada chamada ao
+# NumPy (criação de arrays, produto escalar) anula o ganho da vetorização.
+_CNPJ_W1 = (5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_CNPJ_W2 = (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)
+_CPF_W1 = tuple(range(10, 1, -1))
+_CPF_W2 = tuple(range(11, 1, -1))
+
+def _digitos(numero: str) -> list[int]:
+    """
+    Converte uma string só de dígitos em uma lista de inteiros (uma conversão por
+    caractere). Usa int() para aceitar dígitos Unicode (ex.: de largura total, comuns
+    em OCR); caracteres que str.isdigit aceita mas int não (ex.: '²') levantam ValueError.
+    """
+    return [int(c) for c in numero]
+
+def validar_cnpj(cnpj: str, ja_limpo: bool = False) -> bool:
+    """Valida um CNPJ. Use ja_limpo=True se `cnpj` já contém apenas dígitos."""
+    if not ja_limpo:
+        cnpj = ''.join(filter(str.isdigit, cnpj))
     if len(cnpj) != 14 or len(set(cnpj)) == 1:
         return False
     try:
-        pesos = [5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]
-        soma = sum(int(d) * p for d, p in zip(cnpj[:12], pesos))
-        resto = soma % 11
+        # zip() limita cada soma ao tamanho do vetor de pesos, sem fatiar os dígitos
+        digitos = _digitos(cnpj)
+        resto = sum(d * p for d, p in zip(digitos, _CNPJ_W1)) % 11
         dv1 = 0 if resto < 2 else 11 - resto
-        if dv1 != int(cnpj[12]): return False
-        pesos = [6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]
-        soma = sum(int(d) * p for d, p in zip(cnpj[:13], pesos))
-        resto = soma % 11
+        if dv1 != digitos[12]: return False
+        resto = sum(d * p for d, p in zip(digitos, _CNPJ_W2)) % 11
         dv2 = 0 if resto < 2 else 11 - resto
-        if dv2 != int(cnpj[13]): return False
+        if dv2 != digitos[13]: return False
         return True
     except (ValueError, IndexError): return False
 
-def validar_cpf(cpf: str) -> bool:
-    cpf = ''.join(filter(str.isdigit, cpf))
+def validar_cpf(cpf: str, ja_limpo: bool = False) -> bool:
+    """Valida um CPF. Use ja_limpo=True se `cpf` já contém apenas dígitos."""
+    if not ja_limpo:
+        cpf = ''.join(filter(str.isdigit, cpf))
     if len(cpf) != 11 or len(set(cpf)) == 1: return False
     try:
-        soma = sum(int(cpf[i]) * (10 - i) for i in range(9))
-        resto = (soma * 10) % 11
+        digitos = _digitos(cpf)
+        resto = (sum(d * p for d, p in zip(digitos, _CPF_W1)) * 10) % 11
         if resto == 10: resto = 0
-        if resto != int(cpf[9]): return False
-        soma = sum(int(cpf[i]) * (11 - i) for i in range(10))
-        resto = (soma * 10) % 11
+        if resto != digitos[9]: return False
+        resto = (sum(d * p for d, p in zip(digitos, _CPF_W2)) * 10) % 11
         if resto == 10: resto = 0
-        if resto != int(cpf[10]): return False
+        if resto != digitos[10]: return False
         return True
     except (ValueError, IndexError): return False
 
-VALID_CFOP_CODES = {"6102", "1101", "1102", "1201", "1202", "1401", "1403", "1904", "1916", "2101", "2102", "2201", "2202", "2401", "2403", "2904", "2916", "3101", "3102", "3201", "3202", "5101", "5102", "5116", "5117", "5401", "5403", "5405", "5656", "5904", "5929", "6101", "6108", "6401", "6403", "6404", "6656", "6904", "6929", "7101", "7102", "7127"}
+VALID_CFOP_CODES = frozenset({"6102", "1101", "1102", "1201", "1202", "1401", "1403", "1904", "1916", "2101", "2102", "2201", "2202", "2401", "2403", "2904", "2916", "3101", "3102", "3201", "3202", "5101", "5102", "5116", "5117", "5401", "5403", "5405", "5656", "5904", "5929", "6101", "6108", "6401", "6403", "6404", "6656", "6904", "6929", "7101", "7102", "7127"})
 
 def _auditar_dados_nfs_ocr(dados: dict) -> tuple[list, list]:
     errors = []
@@ -81,16 +162,62 @@ def _auditar_dados_nfs_ocr(dados: dict) -> tuple[list, list]:
     dest_doc = dados.get('destinatario_cnpj_cpf')
     if not dest_doc: 
         warnings.append("CPF/CNPJ do destinatário (tomador) não informado.")
-    elif len(''.join(filter(str.isdigit, dest_doc))) > 11 and not validar_cnpj(dest_doc):
-        errors.append(f"CNPJ do destinatário '{dest_doc}' é inválido.")
-    elif len(''.join(filter(str.isdigit, dest_doc))) <= 11 and not validar_cpf(dest_doc):
-        errors.append(f"CPF do destinatário '{dest_doc}' é inválido.")
+    else:
+        # Extrai os dígitos uma única vez para decidir entre CPF e CNPJ e validar
+        dest_digitos = ''.join(filter(str.isdigit, dest_doc))
+        if len(dest_digitos) > 11 and not validar_cnpj(dest_digitos, ja_limpo=True):
+            errors.append(f"CNPJ do destinatário '{dest_doc}' é inválido.")
+        elif len(dest_digitos) <= 11 and not validar_cpf(dest_digitos, ja_limpo=True):
+            errors.append(f"CPF do destinatário '{dest_doc}' é inválido.")
     if not dados.get('numero'): errors.append("Número da nota não informado.")
     if not dados.get('data_emissao'): warnings.append("Data de emissão não informada.")
     if not dados.get('valor_total_nota'): errors.append("Valor total da nota não informado.")
     if not dados.get('discriminacao_servicos'): warnings.append("Discriminação dos serviços não informada ou vazia.")
     return errors, warnings
 
+def _auditar_item(i: int, item: dict, ncms_encontrados: dict) -> tuple[list, list, list, int]:
+    """
+    Audita um item de NFe/CTe usando os NCMs já consultados em lote.
+    Retorna (erros, avisos, informações de NCM, valor total do item em centavos).
+    """
+    issues = []
+    warnings = []
+    ncm_info = []
+    item_cents = 0
+    item_prefix = f"Item {i} ({item.get('codigo', 'S/C')}) - "
+    ncm = item.get('ncm')
+    if not ncm:
+        issues.append(f"{item_prefix}NCM não informado.")
+    else:
+        resultado_ncm = ncms_encontrados.get(ncm)
+        if not resultado_ncm:
+            issues.append(f"{item_prefix}NCM '{ncm}' é inválido ou não foi encontrado na Tabela TIPI.")
+        else:
+            # Adiciona informações do NCM para a conclusão
+            ncm_info.append(
+                f"Item {item.get('codigo', 'S/C')} (NCM {resultado_ncm['ncm_encontrado']}): "
+                f"Descrição: {resultado_ncm['descricao']}, "
+                f"Alíquota IPI: {resultado_ncm['aliquota']}%"
+            )
+            try:
+                pIPI_doc_str = item.get('pIPI') # Modificado para o novo formato simplificado
+                if pIPI_doc_str is not None:
+                    pIPI_doc = _to_decimal(pIPI_doc_str)
+                    pIPI_tipi = _to_decimal(resultado_ncm.get('aliquota', '0'))
+                    if pIPI_doc != pIPI_tipi:
+                        warnings.append(f"{item_prefix}Alíquota de IPI ({pIPI_doc}%) diverge da Tabela TIPI ({pIPI_tipi}%).")
+            except (InvalidOperation, TypeError):
+                warnings.append(f"{item_prefix}Não foi possível validar a alíquota de IPI. Valor inválido no documento.")
+
+    if not item.get('cfop') or item.get('cfop') not in VALID_CFOP_CODES:
+        warnings.append(f"{item_prefix}CFOP '{item.get('cfop', '')}' não consta na lista de códigos válidos.")
+
+    try:
+        item_cents = _to_cents(item.get('valor_total', '0'))
+    except (InvalidOperation, TypeError):
+        issues.append(f"{item_prefix}Contém valor total inválido.")
+    return issues, warnings, ncm_info, item_cents
+
 @tool
 def auditar_e_salvar_dados_fiscais(dados_json: str) -> str:
     """
@@ -113,50 +240,35 @@ def auditar_e_salvar_dados_fiscais(dados_json: str) -> str:
     if dados.get('formato') in ['ocr', 'ocr_ia']:
         issues, warnings = _auditar_dados_nfs_ocr(dados)
     else:
-        calculated_sum = Decimal('0.00')
+        # Soma em centavos inteiros: cada valor é convertido uma única vez
+        calculated_cents = 0
         if not dados.get('numero'): issues.append("Número do documento não informado.")
         if not dados.get('emitente_cnpj') or not validar_cnpj(dados.get('emitente_cnpj', '')):
             issues.append(f"CNPJ do emitente '{dados.get('emitente_cnpj', '')}' é inválido ou não informado.")
         
         items = dados.get('itens', [])
         if not items: warnings.append("O documento não contém itens.")
+
+        # Consulta todos os NCMs do documento de uma só vez, em vez de uma query por item
+        ncms = [it.get('ncm') for it in items if it.get('ncm')]
+        ncms_encontrados = consultar_ncms_batch(ncms, db_file='tipi/tipi.db')
         
+        # Cada item é auditado de forma independente; os resultados são combinados na ordem dos itens
         for i, item in enumerate(items, 1):
-            item_prefix = f"Item {i} ({item.get('codigo', 'S/C')}) - "
-            ncm = item.get('ncm')
-            if not ncm:
-                issues.append(f"{item_prefix}NCM não informado.")
-            else:
-                resultado_ncm = consultar_ncm(ncm, db_file='tipi/tipi.db')
-                if not resultado_ncm:
-                    issues.append(f"{item_prefix}NCM '{ncm}' é inválido ou não foi encontrado na Tabela TIPI.")
-                else:
-                    # Adiciona informações do NCM para a conclusão
-                    ncm_info.append(
-                        f"Item {item.get('codigo', 'S/C')} (NCM {resultado_ncm['ncm_encontrado']}): "
-                        f"Descrição: {resultado_ncm['descricao']}, "
-                        f"Alíquota IPI: {resultado_ncm['aliquota']}%"
-                    )
-                    try:
-                        pIPI_doc_str = item.get('pIPI') # Modificado para o novo formato simplificado
-                        if pIPI_doc_str is not None:
-                            pIPI_doc = _to_decimal(pIPI_doc_str)
-                            pIPI_tipi = _to_decimal(resultado_ncm.get('aliquota', '0'))
-                            if pIPI_doc != pIPI_tipi:
-                                warnings.append(f"{item_prefix}Alíquota de IPI ({pIPI_doc}%) diverge da Tabela TIPI ({pIPI_tipi}%).")
-                    except (InvalidOperation, TypeError):
-                        warnings.append(f"{item_prefix}Não foi possível validar a alíquota de IPI. Valor inválido no documento.")
-
-            if not item.get('cfop') or item.get('cfop') not in VALID_CFOP_CODES:
-                warnings.append(f"{item_prefix}CFOP '{item.get('cfop', '')}' não consta na lista de códigos válidos.")
-            
-            try:
-                calculated_sum += _to_decimal(item.get('valor_total', '0'))
-            except (InvalidOperation, TypeError):
-                issues.append(f"{item_prefix}Contém valor total inválido.")
-
-        doc_total = _to_decimal(dados.get('valor_total_nota', '0'))
-        if abs(calculated_sum - doc_total) > Decimal('0.01'):
+            item_issues, item_warnings, item_ncm_info, item_cents = _auditar_item(i, item, ncms_encontrados)
+            issues.extend(item_issues)
+            warnings.extend(item_warnings)
+            ncm_info.extend(item_ncm_info)
+            calculated_cents += item_cents
+
+        try:
+            doc_cents = _to_cents(dados.get('valor_total_nota', '0'))
+        except (InvalidOperation, TypeError):
+            doc_cents = None
+            issues.append(f"Valor total da nota '{dados.get('valor_total_nota', '')}' é inválido.")
+        if doc_cents is not None and abs(calculated_cents - doc_cents) > 1:
+            calculated_sum = Decimal(calculated_cents).scaleb(-2)
+            doc_total = Decimal(doc_cents).scaleb(-2)
             issues.append(f"A soma dos itens ({calculated_sum:.2f}) difere do valor total da nota ({doc_total:.2f}).")
 
     status = 'error' if issues else ('warning' if warnings else 'success')
@@ -167,8 +279,13 @@ def auditar_e_salvar_dados_fiscais(dados_json: str) -> str:
             ("system", "Você é um assistente fiscal especialista. Sua tarefa é gerar uma conclusão clara e útil com base nos resultados de uma auditoria de documento fiscal. Analise os erros, avisos e as informações de NCM para gerar a conclusão. Na sua conclusão, além de mencionar os erros e avisos, liste explicitamente a descrição e a alíquota da TIPI para cada NCM encontrado."),
             ("human", f"Por favor, gere uma conclusão para a seguinte auditoria:\n- Erros Encontrados: {json.dumps(issues)}\n- Avisos Emitidos: {json.dumps(warnings)}\n- Informações de NCM Encontradas: {json.dumps(ncm_info)}")
         ])
-        chain_conclusao = prompt_conclusao | llm
-        conclusao_analise = chain_conclusao.invoke({}).content
+        # Roteamento de modelo: o gpt-4-turbo fica reservado para auditorias com erros
+        complexidade = len(issues) + len(warnings) + len(ncm_info)
+        llm_conclusao = llm_mini if not issues and complexidade <= LIMITE_COMPLEXIDADE_LLM_MINI else llm
+        chain_conclusao = prompt_conclusao | llm_conclusao
+        # Com streaming=True os tokens são emitidos via callbacks (tag TAG_CONCLUSAO);
+        # a resposta concatenada é a que será persistida no banco.
+        conclusao_analise = chain_conclusao.invoke({}, config={"tags": [TAG_CONCLUSAO]}).content
     else:
         conclusao_analise = "Auditoria concluída com sucesso. Nenhuma inconsistência fiscal foi encontrada e todos os dados parecem estar em conformidade."
 
@@ -181,13 +298,9 @@ def auditar_e_salvar_dados_fiscais(dados_json: str) -> str:
     audit_result.update(dados)
 
     try:
-        banco_de_dados = []
-        if os.path.exists('db_documentos.json') and os.path.getsize('db_documentos.json') > 0:
-            with open('db_documentos.json', 'r', encoding='utf-8') as f:
-                banco_de_dados = json.load(f)
-        banco_de_dados.append(audit_result)
-        with open('db_documentos.json', 'w', encoding='utf-8') as f:
-            json.dump(banco_de_dados, f, indent=4, ensure_ascii=False)
+        # Append-only: cada auditoria é uma linha do JSONL, sem reler o banco inteiro
+        with _DB_LOCK, open(DB_DOCUMENTOS, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(audit_result, ensure_ascii=False) + '\n')
         
         return json.dumps({"status": "SUCESSO", "mensagem": conclusao_analise})
 
@@ -196,17 +309,20 @@ def auditar_e_salvar_dados_fiscais(dados_json: str) -> str:
 
 # --- Funções e Ferramentas do Agente ---
 
+def _local(tag: str) -> str:
+    """Remove o namespace ('{uri}nome' -> 'nome') de uma tag lxml."""
+    return tag.rpartition('}')[2]
+
 def element_to_dict(element):
     """Converte um elemento lxml e seus filhos em um dicionário, tratando namespaces."""
     if element is None: return None
-    tag = etree.QName(element).localname
+    tag = _local(element.tag)
     d = {tag: {} if element.attrib else None}
-    children = list(element)
-    if children:
+    if len(element) > 0:
         dd = {}
-        for child in children:
+        for child in element:
             child_dict = element_to_dict(child)
-            child_tag = etree.QName(child).localname
+            child_tag = _local(child.tag)
             if child_tag in dd:
                 if not isinstance(dd[child_tag], list):
                     dd[child_tag] = [dd[child_tag]]
@@ -220,6 +336,42 @@ def element_to_dict(element):
         elif isinstance(d[tag], dict): d[tag]['text'] = element.text
     return d
 
+# Campos lidos de cada seção do XML (pelo nome local, sem namespace)
+_CAMPOS_SECOES_XML = {
+    'ide': ('nNF', 'nCT', 'dhEmi'),
+    'emit': ('xNome', 'CNPJ'),
+    'dest': ('xNome', 'CNPJ', 'CPF'),
+    'ICMSTot': ('vNF',),
+}
+
+def _texto_filho(element, nome):
+    """Retorna o texto do primeiro filho direto de `element` com o nome local informado."""
+    if element is None: return None
+    for child in element:
+        if isinstance(child.tag, str) and _local(child.tag) == nome:
+            return child.text.strip() if child.text is not None else None
+    return None
+
+def _extrair_item_xml(det) -> dict:
+    """Extrai os campos de um item (<det>) de NFe."""
+    prod_node = imposto_node = None
+    for child in det:
+        child_tag = _local(child.tag) if isinstance(child.tag, str) else None
+        if child_tag == 'prod' and prod_node is None: prod_node = child
+        elif child_tag == 'imposto' and imposto_node is None: imposto_node = child
+    pIPI = None
+    if imposto_node is not None:
+        for ipi_trib in imposto_node.iter('{*}IPITrib'):
+            pIPI = _texto_filho(ipi_trib, 'pIPI')
+            if pIPI is not None: break
+    return {
+        "codigo": _texto_filho(prod_node, 'cProd'), "descricao": _texto_filho(prod_node, 'xProd'),
+        "ncm": _texto_filho(prod_node, 'NCM'), "cfop": _texto_filho(prod_node, 'CFOP'),
+        "valor_total": _texto_filho(prod_node, 'vProd'),
+        # Extrai apenas o pIPI, que é o único campo usado na auditoria
+        "pIPI": pIPI
+    }
+
 @tool
 def extrair_dados_xml(caminho_arquivo: str) -> str:
     """
@@ -227,44 +379,37 @@ def extrair_dados_xml(caminho_arquivo: str) -> str:
     Recebe o caminho do arquivo e retorna uma string JSON com os dados extraídos.
     """
     try:
-        with open(caminho_arquivo, 'rb') as f: doc = etree.parse(f)
-        root = doc.getroot()
-        ns = {'doc': root.nsmap.get(None)}
-        def get_text(element, path): 
-            node = element.find(path, ns) if element is not None else None
-            if node is not None and node.text is not None:
-                return node.text.strip()
-            return None
-
-        ide_node = doc.find('.//doc:ide', ns)
-        emit_node = doc.find('.//doc:emit', ns)
-        dest_node = doc.find('.//doc:dest', ns)
-        total_node = doc.find('.//doc:ICMSTot', ns)
+        # Passada única pelo XML: cada seção é lida ao ser fechada e depois liberada
+        secoes = {}
+        itens = []
+        raiz = None
+        for _, elem in etree.iterparse(caminho_arquivo, events=('end',)):
+            raiz = elem
+            tag = _local(elem.tag)
+            if tag == 'det':
+                itens.append(_extrair_item_xml(elem))
+                elem.clear(keep_tail=True)
+            elif tag in _CAMPOS_SECOES_XML and tag not in secoes:
+                secoes[tag] = {campo: _texto_filho(elem, campo) for campo in _CAMPOS_SECOES_XML[tag]}
+                elem.clear(keep_tail=True)
+
+        ide = secoes.get('ide', {})
+        emit = secoes.get('emit', {})
+        dest = secoes.get('dest', {})
+        total = secoes.get('ICMSTot', {})
 
         dados = {
-            "tipo_documento": etree.QName(root).localname.replace('Proc', '').upper(),
-            "numero": get_text(ide_node, 'doc:nNF') or get_text(ide_node, 'doc:nCT'),
-            "data_emissao": get_text(ide_node, 'doc:dhEmi'),
-            "emitente_razao_social": get_text(emit_node, 'doc:xNome'),
-            "emitente_cnpj": get_text(emit_node, 'doc:CNPJ'),
-            "destinatario_razao_social": get_text(dest_node, 'doc:xNome'),
-            "destinatario_cnpj_cpf": get_text(dest_node, 'doc:CNPJ') or get_text(dest_node, 'doc:CPF'),
-            "valor_total_nota": get_text(total_node, 'doc:vNF'),
-            "itens": []
+            "tipo_documento": _local(raiz.tag).replace('Proc', '').upper(),
+            "numero": ide.get('nNF') or ide.get('nCT'),
+            "data_emissao": ide.get('dhEmi'),
+            "emitente_razao_social": emit.get('xNome'),
+            "emitente_cnpj": emit.get('CNPJ'),
+            "destinatario_razao_social": dest.get('xNome'),
+            "destinatario_cnpj_cpf": dest.get('CNPJ') or dest.get('CPF'),
+            "valor_total_nota": total.get('vNF'),
+            "itens": itens
         }
 
-        for det in doc.findall('.//doc:det', ns):
-            prod_node = det.find('doc:prod', ns)
-            imposto_node = det.find('doc:imposto', ns)
-            item = {
-                "codigo": get_text(prod_node, 'doc:cProd'), "descricao": get_text(prod_node, 'doc:xProd'),
-                "ncm": get_text(prod_node, 'doc:NCM'), "cfop": get_text(prod_node, 'doc:CFOP'),
-                "valor_total": get_text(prod_node, 'doc:vProd'),
-                # Extrai apenas o pIPI, que é o único campo usado na auditoria
-                "pIPI": get_text(imposto_node, './/doc:IPITrib/doc:pIPI')
-            }
-            dados["itens"].append(item)
-
         # Validação de dados essenciais extraídos
         if not dados.get("numero") or not dados.get("emitente_cnpj"):
             return json.dumps({"erro": "Falha ao extrair dados essenciais do XML. O arquivo pode não ser um documento fiscal válido ou ter uma estrutura não suportada."})
@@ -275,6 +420,9 @@ def extrair_dados_xml(caminho_arquivo: str) -> str:
     except Exception as e:
         return json.dumps({"erro": f"Falha ao processar XML: {e}"})
 
+# Bloco ```json ... ``` retornado pelo LLM na extração de dados
+_JSON_FENCE_RE = re.compile(r"```json\n({.*?})\n```", re.DOTALL)
+
 def extrair_dados_com_ia(texto_cru: str, llm_instance) -> str:
     """Usa IA para extrair dados de texto e garante retorno de JSON."""
     prompt_extracao = ChatPromptTemplate.from_messages([
@@ -283,7 +431,7 @@ def extrair_dados_com_ia(texto_cru: str, llm_instance) -> str:
     ])
     chain_extracao = prompt_extracao | llm_instance
     raw_output = chain_extracao.invoke({"texto_documento": texto_cru}).content
-    json_match = re.search(r"```json\n({.*?})\n```", raw_output, re.DOTALL)
+    json_match = _JSON_FENCE_RE.search(raw_output)
     if json_match: return json_match.group(1)
     try:
         start = raw_output.find('{')
@@ -292,18 +440,78 @@ def extrair_dados_com_ia(texto_cru: str, llm_instance) -> str:
     except ValueError: pass
     return raw_output
 
+# Cache em disco das extrações por IA, indexado pelo hash do texto do PDF.
+# Evita uma nova chamada ao LLM quando o mesmo documento é enviado novamente.
+CACHE_EXTRACAO_DIR = '.cache_extracao_pdf'
+
+def _chave_cache_extracao(texto: str, llm_instance) -> str:
+    """Hash do texto do documento e do modelo usado na extração."""
+    conteudo = f"{llm_instance.model_name}\n{texto}".encode('utf-8')
+    return hashlib.blake2b(conteudo, digest_size=16).hexdigest()
+
+def _ler_cache_extracao(chave: str):
+    caminho = os.path.join(CACHE_EXTRACAO_DIR, f"{chave}.json")
+    if not os.path.exists(caminho):
+        return None
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def _salvar_cache_extracao(chave: str, json_extraido_str: str):
+    os.makedirs(CACHE_EXTRACAO_DIR, exist_ok=True)
+    caminho = os.path.join(CACHE_EXTRACAO_DIR, f"{chave}.json")
+    # Grava em arquivo temporário e renomeia, para nunca deixar um cache incompleto
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporario, 'w', encoding='utf-8') as f:
+        f.write(json_extraido_str)
+    os.replace(temporario, caminho)
+
+# Os campos de uma NFS-e ficam no cabeçalho do documento: apenas o início do
+# texto é enviado à IA, reduzindo tokens de entrada (custo e latência).
+_LIMITE_TEXTO_EXTRACAO = 4000
+# Campos que, se ausentes na extração do trecho inicial, exigem o texto completo
+_CAMPOS_ESSENCIAIS_PDF = ('cnpj_emitente', 'numero', 'valor_total_nota')
+
+def _extrair_dados_pdf_com_ia(texto_completo: str, llm_instance) -> str:
+    """
+    Extrai os dados com IA a partir do início do texto do PDF. Se o resultado
+    não for um JSON válido ou faltar algum campo essencial, repete a extração
+    com o texto completo.
+    """
+    if len(texto_completo) > _LIMITE_TEXTO_EXTRACAO:
+        json_extraido_str = extrair_dados_com_ia(texto_completo[:_LIMITE_TEXTO_EXTRACAO], llm_instance)
+        try:
+            dados = json.loads(json_extraido_str)
+            if isinstance(dados, dict) and all(dados.get(campo) for campo in _CAMPOS_ESSENCIAIS_PDF):
+                return json_extraido_str
+        except json.JSONDecodeError:
+            pass
+    return extrair_dados_com_ia(texto_completo, llm_instance)
+
 @tool
 def extrair_dados_pdf(caminho_arquivo: str) -> str:
     """Extrai dados de um PDF de documento fiscal usando IA."""
     try:
         with fitz.open(caminho_arquivo) as doc:
             texto_completo = "".join(page.get_text() for page in doc)
-        json_extraido_str = extrair_dados_com_ia(texto_completo, llm)
-        dados_extraidos = json.loads(json_extraido_str)
+        chave_cache = _chave_cache_extracao(texto_completo, llm)
+        json_extraido_str = _ler_cache_extracao(chave_cache)
+        veio_do_cache = json_extraido_str is not None
+        if veio_do_cache:
+            dados_extraidos = json.loads(json_extraido_str)
+        if not veio_do_cache or not isinstance(dados_extraidos, dict):
+            # Sem cache (ou com uma entrada inválida gravada por versões anteriores)
+            veio_do_cache = False
+            json_extraido_str = _extrair_dados_pdf_com_ia(texto_completo, llm)
+            dados_extraidos = json.loads(json_extraido_str)
+        if not isinstance(dados_extraidos, dict):
+            raise ValueError("a IA não retornou um objeto JSON com os dados da nota.")
         dados_extraidos['emitente_cnpj'] = dados_extraidos.pop('cnpj_emitente', None)
         dados_extraidos['destinatario_cnpj_cpf'] = dados_extraidos.pop('destinatario_cnpj', dados_extraidos.pop('destinatario_cpf', None))
         dados_extraidos['formato'] = 'ocr_ia'
         dados_extraidos['tipo_documento'] = 'NFS-e'
+        if not veio_do_cache:
+            # Só armazena extrações que resultaram em um objeto JSON utilizável
+            _salvar_cache_extracao(chave_cache, json_extraido_str)
         return json.dumps(dados_extraidos)
     except Exception as e:
         return json.dumps({"erro": f"Falha ao processar PDF: {e}"})
@@ -342,4 +550,22 @@ prompt = ChatPromptTemplate.from_messages([
 ])
 
 agent = create_openai_tools_agent(llm, tools, prompt)
-agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
\ No newline at end of file
+agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+
+# Limite de documentos processados simultaneamente (respeita o limite de TPM da OpenAI)
+MAX_CONCORRENCIA_LOTE = 8
+
+def tarefa_processamento(caminho_arquivo: str) -> str:
+    """Monta a instrução do agente para processar um documento fiscal."""
+    return f"Extraia, audite e salve no banco de dados o documento fiscal '{caminho_arquivo}'"
+
+async def audit_many(paths: list[str]) -> list:
+    """
+    Processa vários documentos concorrentemente com o agente.
+    Retorna, na mesma ordem de `paths`, o resultado do agente para cada
+    documento ou a exceção que interrompeu seu processamento.
+    """
+    inputs = [{"input": tarefa_processamento(p)} for p in paths]
+    return await agent_executor.abatch(
+        inputs, config={"max_concurrency": MAX_CONCORRENCIA_LOTE}, return_exceptions=True
+    )
\ No newline at end of file
@@ -4,34 +4,151 @@ import streamlit as st
 import os
 import pandas as pd
 import json
-from agente_fiscal_langchain import agent_executor
+import asyncio
+import tempfile
+from langchain_core.callbacks import BaseCallbackHandler
+from agente_fiscal_langchain import agent_executor, audit_many, tarefa_processamento, TAG_CONCLUSAO, DB_DOCUMENTOS
 from tipi.atualizartipi import baixar_tipi_xlsx, processar_tipi_para_sqlite
+from tipi.consultartipi import renovar_conexao
 
 # --- ATUALIZAÇÃO AUTOMÁTICA DA TABELA TIPI ---
-print("Verificando e atualizando a tabela TIPI...")
-tentativa_de_download = baixar_tipi_xlsx(output_filename="tipi/tipi_download.xlsx")
-if tentativa_de_download and os.path.exists(tentativa_de_download):
-    processar_tipi_para_sqlite(tentativa_de_download, db_file="tipi/tipi.db")
+# O Streamlit reexecuta o script a cada interação; o cache garante que o download
+# e a reconstrução do banco ocorram no máximo uma vez por dia por processo.
+# Falhas levantam exceção, que não é armazenada em cache: a próxima execução tenta novamente.
+@st.cache_resource(ttl=86400, show_spinner=False)
+def atualizar_tabela_tipi():
+    print("Verificando e atualizando a tabela TIPI...")
+    tentativa_de_download = baixar_tipi_xlsx(output_filename="tipi/tipi_download.xlsx")
+    if not tentativa_de_download or not os.path.exists(tentativa_de_download):
+        raise RuntimeError("Falha ao baixar a tabela TIPI.")
+    if not processar_tipi_para_sqlite(tentativa_de_download, db_file="tipi/tipi.db"):
+        raise RuntimeError("Falha ao processar a tabela TIPI baixada.")
+    # Reabre a conexão e descarta consultas feitas sobre a versão anterior da tabela
+    renovar_conexao()
     print("Tabela TIPI atualizada com sucesso.")
-else:
-    print("Falha ao baixar a tabela TIPI. Usando a versão local, se existir.")
+
+try:
+    atualizar_tabela_tipi()
+except RuntimeError as e:
+    print(f"{e} Usando a versão local, se existir.")
 
 # --- Funções de Lógica do App ---
 
-def ler_registros_do_banco() -> str:
+def ler_registros_do_banco():
+    """
+    Lê os registros do 'banco de dados' (um arquivo JSON Lines, um
+    documento por linha), produzindo um documento de cada vez.
+    """
+    if not os.path.exists(DB_DOCUMENTOS):
+        return
+    with open(DB_DOCUMENTOS, 'r', encoding='utf-8') as f:
+        for linha in f:
+            if not linha.strip():
+                continue
+            try:
+                yield json.loads(linha)
+            except json.JSONDecodeError:
+                # Ignora linhas corrompidas (ex.: gravação interrompida)
+                continue
+
+def achatar_registros(registros):
     """
-    Lê os registros do 'banco de dados' (atualmente um arquivo JSON)
-    e retorna como uma string JSON.
+    Converte os documentos auditados em linhas planas para o dashboard:
+    uma linha por item ou, para documentos sem itens, uma linha por documento.
     """
-    db_file = 'db_documentos.json'
-    if not os.path.exists(db_file):
-        return json.dumps([])
-    with open(db_file, 'r', encoding='utf-8') as f:
+    for doc_auditado in registros:
+        # A estrutura de dados agora é plana. Acessamos os campos diretamente.
+        if not doc_auditado: continue
+
+        info_base = {
+            'status_auditoria': doc_auditado.get('status_auditoria'),
+            'numero_nota': doc_auditado.get('numero'),
+            'conclusao_analise': doc_auditado.get('conclusao_analise'), # Nova coluna
+            'data_emissao': doc_auditado.get('data_emissao'),
+            'emitente': doc_auditado.get('emitente_razao_social'),
+            'emitente_cnpj': doc_auditado.get('emitente_cnpj'),
+            'destinatario': doc_auditado.get('destinatario_razao_social'),
+            'destinatario_cnpj_cpf': doc_auditado.get('destinatario_cnpj_cpf'),
+            'valor_total_nota': doc_auditado.get('valor_total_nota'),
+            'tipo_documento': doc_auditado.get('tipo_documento'),
+            'formato': doc_auditado.get('formato'),
+            'discriminacao_servicos': doc_auditado.get('discriminacao_servicos'),
+            'erros': ", ".join(doc_auditado.get('erros_auditoria', [])),
+            'avisos': ", ".join(doc_auditado.get('avisos_auditoria', []))
+        }
+
+        itens = doc_auditado.get('itens', [])
+        if itens and isinstance(itens, list):
+            for item in itens:
+                linha = info_base.copy()
+                linha['item_codigo'] = item.get('codigo')
+                linha['item_descricao'] = item.get('descricao')
+                linha['item_ncm'] = item.get('ncm')
+                linha['item_cfop'] = item.get('cfop')
+                linha['item_valor_total'] = item.get('valor_total')
+                yield linha
+        else:
+            # Para documentos sem itens (como NFS-e de OCR), usa o valor total da nota como o valor do item.
+            info_base['item_valor_total'] = info_base.get('valor_total_nota')
+            yield info_base
+
+def salvar_upload(uploaded_file) -> str:
+    """
+    Salva um arquivo enviado pelo usuário na pasta temporária e retorna o caminho.
+    Cada upload recebe um nome único (mantendo nome e extensão originais como
+    referência), para que arquivos homônimos de um lote não se sobrescrevam.
+    """
+    temp_dir = "temp_uploads"
+    if not os.path.exists(temp_dir): os.makedirs(temp_dir)
+    nome_base, extensao = os.path.splitext(uploaded_file.name)
+    fd, file_path = tempfile.mkstemp(suffix=extensao, prefix=f"{nome_base}_", dir=temp_dir)
+    with os.fdopen(fd, "wb") as f: f.write(uploaded_file.getbuffer())
+    return file_path
+
+def remover_uploads(caminhos) -> None:
+    """Apaga os arquivos temporários de upload após o processamento."""
+    for caminho in caminhos:
         try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            data = []
-    return json.dumps(data)
+            os.remove(caminho)
+        except OSError:
+            pass
+
+class ConclusaoStreamHandler(BaseCallbackHandler):
+    """
+    Exibe no Streamlit, token a token, a conclusão gerada pela ferramenta de auditoria.
+    Os tokens das demais chamadas ao LLM (raciocínio do agente) são ignorados.
+    """
+    def __init__(self, container):
+        self.container = container
+        self.area_texto = None
+        self.texto = ""
+        # Execução (run_id) da conclusão em exibição; se o agente chamar a auditoria
+        # novamente, apenas a última conclusão gerada é mantida.
+        self.run_id_atual = None
+
+    def _exibir(self, texto: str) -> None:
+        # A seção só é criada quando há de fato uma conclusão gerada pela IA
+        if self.area_texto is None:
+            self.container.subheader("📝 Conclusão da Auditoria")
+            self.area_texto = self.container.empty()
+        self.area_texto.markdown(texto)
+
+    def on_llm_new_token(self, token: str, *, run_id=None, tags=None, **kwargs) -> None:
+        if tags and TAG_CONCLUSAO in tags:
+            if run_id != self.run_id_atual:
+                # Nova conclusão: descarta o texto da anterior
+                self.run_id_atual = run_id
+                self.texto = ""
+            self.texto += token
+            self._exibir(self.texto + "▌")
+
+    def on_llm_end(self, response, *, run_id=None, tags=None, **kwargs) -> None:
+        if tags and TAG_CONCLUSAO in tags:
+            # Usa o texto final da geração, que também cobre respostas vindas do
+            # cache (estas não emitem tokens).
+            self.run_id_atual = run_id
+            self.texto = response.generations[0][0].text
+            self._exibir(self.texto)
 
 # --- Configuração da Página ---
 st.set_page_config(page_title="Agente Fiscal Inteligente", page_icon="🤖", layout="wide")
@@ -49,19 +166,26 @@ with tab_processamento:
     uploaded_file = st.file_uploader("Selecione o documento fiscal (XML ou PDF)", type=['xml', 'pdf'])
 
     if uploaded_file is not None:
-        temp_dir = "temp_uploads"
-        if not os.path.exists(temp_dir): os.makedirs(temp_dir)
-        file_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(file_path, "wb") as f: f.write(uploaded_file.getbuffer())
-
         if st.button("Analisar Documento", type="primary", use_container_width=True):
-            tarefa = f"Extraia, audite e salve no banco de dados o documento fiscal '{file_path}'"
+            # O arquivo só é gravado ao analisar (o Streamlit reexecuta o script a cada interação)
+            file_path = salvar_upload(uploaded_file)
+            tarefa = tarefa_processamento(file_path)
             
+            conclusao_stream = ConclusaoStreamHandler(st.container())
+
             with st.spinner('O Agente está trabalhando...'):
                 try:
-                    resultado = agent_executor.invoke({"input": tarefa})
+                    try:
+                        resultado = agent_executor.invoke({"input": tarefa}, config={"callbacks": [conclusao_stream]})
+                    finally:
+                        remover_uploads([file_path])
                     st.subheader("✅ Análise Concluída")
-                    st.markdown(resultado["output"])
+                    if conclusao_stream.texto:
+                        # A conclusão já foi exibida acima; a resposta do agente a repete
+                        with st.expander("Ver a resposta completa do Agente"):
+                            st.markdown(resultado["output"])
+                    else:
+                        st.markdown(resultado["output"])
                     st.cache_data.clear()
                     
                     with st.expander("Ver o raciocínio detalhado do Agente"):
@@ -70,6 +194,32 @@ with tab_processamento:
                 except Exception as e:
                     st.error(f"Ocorreu um erro: {e}")
 
+    st.divider()
+    st.header("Análise em Lote")
+    uploaded_files = st.file_uploader(
+        "Selecione vários documentos fiscais (XML ou PDF)", type=['xml', 'pdf'],
+        accept_multiple_files=True, key="upload_lote"
+    )
+
+    if uploaded_files:
+        if st.button(f"Analisar {len(uploaded_files)} Documentos", type="primary", use_container_width=True):
+            file_paths = [salvar_upload(f) for f in uploaded_files]
+
+            with st.spinner('O Agente está processando os documentos em paralelo...'):
+                try:
+                    resultados = asyncio.run(audit_many(file_paths))
+                finally:
+                    remover_uploads(file_paths)
+            st.cache_data.clear()
+
+            st.subheader("✅ Análise em Lote Concluída")
+            for uploaded, resultado in zip(uploaded_files, resultados):
+                with st.expander(uploaded.name):
+                    if isinstance(resultado, Exception):
+                        st.error(f"Ocorreu um erro: {resultado}")
+                    else:
+                        st.markdown(resultado["output"])
+
 # --- ABA 2: DASHBOARD (LÓGICA CORRIGIDA) ---
 with tab_dashboard:
     st.header("Documentos Fiscais Processados")
@@ -79,51 +229,13 @@ with tab_dashboard:
 
     @st.cache_data(ttl=60)
     def carregar_dados():
-        dados_json = ler_registros_do_banco()
-        return json.loads(dados_json)
-
-    dados = carregar_dados()
-
-    if isinstance(dados, list) and dados:
-        dados_planos = []
-        for doc_auditado in dados:
-            # A estrutura de dados agora é plana. Acessamos os campos diretamente.
-            if not doc_auditado: continue
-
-            info_base = {
-                'status_auditoria': doc_auditado.get('status_auditoria'),
-                'numero_nota': doc_auditado.get('numero'),
-                'conclusao_analise': doc_auditado.get('conclusao_analise'), # Nova coluna
-                'data_emissao': doc_auditado.get('data_emissao'),
-                'emitente': doc_auditado.get('emitente_razao_social'),
-                'emitente_cnpj': doc_auditado.get('emitente_cnpj'),
-                'destinatario': doc_auditado.get('destinatario_razao_social'),
-                'destinatario_cnpj_cpf': doc_auditado.get('destinatario_cnpj_cpf'),
-                'valor_total_nota': doc_auditado.get('valor_total_nota'),
-                'tipo_documento': doc_auditado.get('tipo_documento'),
-                'formato': doc_auditado.get('formato'),
-                'discriminacao_servicos': doc_auditado.get('discriminacao_servicos'),
-                'erros': ", ".join(doc_auditado.get('erros_auditoria', [])),
-                'avisos': ", ".join(doc_auditado.get('avisos_auditoria', []))
-            }
-            
-            itens = doc_auditado.get('itens', [])
-            if itens and isinstance(itens, list):
-                for item in itens:
-                    linha = info_base.copy()
-                    linha['item_codigo'] = item.get('codigo')
-                    linha['item_descricao'] = item.get('descricao')
-                    linha['item_ncm'] = item.get('ncm')
-                    linha['item_cfop'] = item.get('cfop')
-                    linha['item_valor_total'] = item.get('valor_total')
-                    dados_planos.append(linha)
-            else:
-                # Para documentos sem itens (como NFS-e de OCR), usa o valor total da nota como o valor do item.
-                info_base['item_valor_total'] = info_base.get('valor_total_nota')
-                dados_planos.append(info_base)
-
-        df = pd.DataFrame(dados_planos)
+        # Os documentos são lidos e achatados um a um; apenas as linhas planas
+        # são acumuladas para o DataFrame, não a lista de registros originais.
+        return pd.DataFrame.from_records(achatar_registros(ler_registros_do_banco()))
+
+    df = carregar_dados()
 
+    if not df.empty:
         # Reordenar colunas para colocar a conclusão em terceiro
         cols = df.columns.tolist()
         if 'conclusao_analise' in cols:
@@ -131,11 +243,12 @@ with tab_dashboard:
             df = df[cols]
 
         colunas_monetarias = ['valor_total_nota', 'item_valor_total']
+        # Remove '.' e troca ',' por '.' em uma única passada por valor
+        traducao_moeda = str.maketrans({'.': '', ',': '.'})
         for col in colunas_monetarias:
             if col in df.columns:
                 # Limpa e converte o formato de moeda (R$ 1.234,56 -> 1234.56)
-                df[col] = df[col].astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+                df[col] = pd.to_numeric(df[col].astype(str).str.translate(traducao_moeda), errors='coerce').fillna(0)
 
         st.dataframe(df, use_container_width=True)
         
@@ -150,7 +263,5 @@ with tab_dashboard:
                 valor_por_nota = df.drop_duplicates(subset=['numero_nota']).set_index('numero_nota')
                 st.bar_chart(valor_por_nota['valor_total_nota'])
 
-    elif isinstance(dados, dict) and 'erro' in dados:
-        st.error(f"Erro ao carregar dados do banco: {dados['erro']}")
     else:
         st.info("Nenhum documento processado ainda. Processe um documento na aba ao lado.")
\ No newline at end of file
@@ -66,6 +66,7 @@ def processar_tipi_para_sqlite(excel_file, db_file="tipi.db", table_name='tipi')
     """
     Lê o arquivo XLSX da TIPI, limpa os dados e salva em SQLite.
     (Versão com tratamento de erro de nome de coluna)
+    Retorna True se o banco foi gravado com sucesso.
     """
     print(f"\nIniciando o processamento do arquivo: {excel_file}")
 
@@ -153,6 +154,7 @@ def processar_tipi_para_sqlite(excel_file, db_file="tipi.db", table_name='tipi')
         })
         conn.close()
         print(f"Banco de dados SQLite salvo com sucesso na tabela '{table_name}'.")
+        return True
 
     except FileNotFoundError:
         print(f"Erro: Arquivo '{excel_file}' não encontrado.")
@@ -1,11 +1,88 @@
 import sqlite3
+import threading
+from collections import OrderedDict
+
+# Cache LRU (em memória, por processo) das consultas de NCM, compartilhado por
+# consultar_ncm e consultar_ncms_batch. A chave é (ncm_codigo, db_file).
+# Deve ser limpo (limpar_cache_ncm ou renovar_conexao) sempre que a tabela TIPI for atualizada.
+_CACHE_NCM_MAXSIZE = 4096
+_cache_ncm = OrderedDict()
+_cache_ncm_lock = threading.Lock()
+
+def _cache_ncm_obter(chave):
+    """Retorna (True, resultado) se a chave estiver no cache, ou (False, None)."""
+    with _cache_ncm_lock:
+        if chave not in _cache_ncm:
+            return False, None
+        _cache_ncm.move_to_end(chave)
+        resultado = _cache_ncm[chave]
+    # Devolve uma cópia para que o chamador não altere o valor em cache
+    return True, dict(resultado) if resultado else None
+
+def _cache_ncm_salvar(chave, resultado):
+    with _cache_ncm_lock:
+        _cache_ncm[chave] = dict(resultado) if resultado else None
+        _cache_ncm.move_to_end(chave)
+        if len(_cache_ncm) > _CACHE_NCM_MAXSIZE:
+            _cache_ncm.popitem(last=False)
+
+def limpar_cache_ncm():
+    """Esvazia o cache de consultas de NCM (usar após atualizar o banco da TIPI)."""
+    with _cache_ncm_lock:
+        _cache_ncm.clear()
+
+# Conexões SQLite reaproveitadas entre consultas (uma por arquivo de banco),
+# abertas sob demanda. O acesso é serializado pelo lock, pois a mesma conexão
+# é compartilhada entre as threads do Streamlit.
+_conexoes = {}
+_conexoes_lock = threading.RLock()
+
+def _obter_conexao(db_file):
+    """Retorna a conexão compartilhada com `db_file`, abrindo-a na primeira chamada."""
+    conn = _conexoes.get(db_file)
+    if conn is None:
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        conn.execute('PRAGMA query_only=1')
+        conn.execute('PRAGMA cache_size=-20000')
+        _conexoes[db_file] = conn
+    return conn
+
+def renovar_conexao():
+    """
+    Fecha as conexões compartilhadas e limpa o cache de NCMs, para que as
+    próximas consultas enxerguem o banco da TIPI recém-atualizado.
+    """
+    with _conexoes_lock:
+        for conn in _conexoes.values():
+            conn.close()
+        _conexoes.clear()
+    limpar_cache_ncm()
 
 def consultar_ncm(ncm_codigo, db_file='tipi.db', original_ncm=None):
     """
     Consulta a alíquota de um NCM no banco de dados SQLite.
     Normaliza o NCM para o formato XXXX.XX.XX e, se não encontrar,
     busca o NCM "pai" recursivamente.
+    Os resultados das consultas são mantidos em cache (ver limpar_cache_ncm).
     """
+    chave = (str(ncm_codigo), db_file)
+    usar_cache = original_ncm is None
+    if usar_cache:
+        encontrado, resultado = _cache_ncm_obter(chave)
+        if encontrado:
+            return resultado
+    try:
+        resultado = _consultar_ncm_sqlite(ncm_codigo, db_file, original_ncm)
+    except sqlite3.Error as e:
+        # Erros não são armazenados em cache
+        print(f"Erro ao consultar o SQLite: {e}")
+        return None
+    if usar_cache:
+        _cache_ncm_salvar(chave, resultado)
+    return resultado
+
+def _consultar_ncm_sqlite(ncm_codigo, db_file, original_ncm=None):
+    """Executa a consulta de consultar_ncm diretamente no SQLite, sem cache."""
     # Normaliza o código NCM para garantir que esteja no formato com pontos
     ncm_digits = ''.join(filter(str.isdigit, str(ncm_codigo)))
     
@@ -20,37 +97,87 @@ def consultar_ncm(ncm_codigo, db_file='tipi.db', original_ncm=None):
     if original_ncm is None:
         original_ncm = ncm_formatado # Armazena o NCM formatado para referência
 
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-
-        # A chave de busca é 'NCM|EX'. Para um NCM principal, o EX é ''.
-        ncm_ex_key = f"{ncm_formatado}|"
-        
-        query = "SELECT ncm, descricao, aliquota, ex FROM tipi WHERE ncm_ex = ?"
-        cursor.execute(query, (ncm_ex_key,))
-        resultado = cursor.fetchone()
-
-        if resultado:
-            return {
-                "ncm_consultado": original_ncm,
-                "ncm_encontrado": resultado[0],
-                "descricao": resultado[1],
-                "aliquota": resultado[2],
-                "ex": resultado[3]
-            }
+    # A chave de busca é 'NCM|EX'. Para um NCM principal, o EX é ''.
+    ncm_ex_key = f"{ncm_formatado}|"
+
+    query = "SELECT ncm, descricao, aliquota, ex FROM tipi WHERE ncm_ex = ?"
+    with _conexoes_lock:
+        resultado = _obter_conexao(db_file).execute(query, (ncm_ex_key,)).fetchone()
+
+    if resultado:
+        return {
+            "ncm_consultado": original_ncm,
+            "ncm_encontrado": resultado[0],
+            "descricao": resultado[1],
+            "aliquota": resultado[2],
+            "ex": resultado[3]
+        }
+    else:
+        # Se não encontrou, tenta buscar o NCM "pai"
+        if '.' in ncm_formatado:
+            ncm_pai = ncm_formatado.rsplit('.', 1)[0]
+            return _consultar_ncm_sqlite(ncm_pai, db_file, original_ncm)
+        else:
+            return None
+
+def consultar_ncms_batch(codigos, db_file='tipi.db'):
+    """
+    Consulta vários NCMs em uma única conexão e uma única query (IN).
+    Aplica a mesma normalização e busca pelo NCM "pai" de consultar_ncm,
+    incluindo todos os ancestrais de cada código na mesma consulta.
+    Retorna um dicionário {ncm_codigo: resultado}, onde resultado segue o
+    formato de consultar_ncm (ou None, se não encontrado).
+    Códigos já presentes no cache não são consultados novamente.
+    """
+    resultados = {}
+    codigos_pendentes = set()
+    for codigo in set(codigos):
+        encontrado, resultado = _cache_ncm_obter((str(codigo), db_file))
+        if encontrado:
+            resultados[codigo] = resultado
+        else:
+            codigos_pendentes.add(codigo)
+    codigos = codigos_pendentes
+    if not codigos:
+        return resultados
+
+    # Para cada código, monta a lista de chaves candidatas (o próprio NCM e seus pais)
+    candidatos_por_codigo = {}
+    for codigo in codigos:
+        ncm_digits = ''.join(filter(str.isdigit, str(codigo)))
+        if len(ncm_digits) == 8:
+            ncm_formatado = f"{ncm_digits[:4]}.{ncm_digits[4:6]}.{ncm_digits[6:]}"
         else:
-            # Se não encontrou, tenta buscar o NCM "pai"
-            if '.' in ncm_formatado:
-                ncm_pai = ncm_formatado.rsplit('.', 1)[0]
-                return consultar_ncm(ncm_pai, db_file, original_ncm)
-            else:
-                return None
+            ncm_formatado = codigo
+        candidatos = [ncm_formatado]
+        while '.' in candidatos[-1]:
+            candidatos.append(candidatos[-1].rsplit('.', 1)[0])
+        candidatos_por_codigo[codigo] = (ncm_formatado, candidatos)
+
+    chaves = {f"{c}|" for _, candidatos in candidatos_por_codigo.values() for c in candidatos}
 
+    try:
+        placeholders = ",".join("?" * len(chaves))
+        query = f"SELECT ncm_ex, ncm, descricao, aliquota, ex FROM tipi WHERE ncm_ex IN ({placeholders})"
+        with _conexoes_lock:
+            encontrados = {row[0]: row[1:] for row in _obter_conexao(db_file).execute(query, tuple(chaves))}
     except sqlite3.Error as e:
         print(f"Erro ao consultar o SQLite: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        resultados.update({codigo: None for codigo in codigos})
+        return resultados
+
+    for codigo, (ncm_formatado, candidatos) in candidatos_por_codigo.items():
+        resultados[codigo] = None
+        for candidato in candidatos:
+            resultado = encontrados.get(f"{candidato}|")
+            if resultado:
+                resultados[codigo] = {
+                    "ncm_consultado": ncm_formatado,
+                    "ncm_encontrado": resultado[0],
+                    "descricao": resultado[1],
+                    "aliquota": resultado[2],
+                    "ex": resultado[3]
+                }
+                break
+        _cache_ncm_salvar((str(codigo), db_file), resultados[codigo])
+    return resultados